@@ -1,8 +1,9 @@
 import os
 import json
 import re
-import string
-import numpy as np
+import time
+import diskcache
+import imageio
 from flask import Flask, request, jsonify, send_from_directory
 from youtube_transcript_api import YouTubeTranscriptApi
 from youtube_transcript_api._errors import TranscriptsDisabled, NoTranscriptFound, VideoUnavailable
@@ -16,6 +17,10 @@ mapping_path = os.path.join(current_dir, "filtered_video_to_gloss.json")
 dataset_dir = os.path.join(current_dir, "word-level-dataset-cpu")
 output_dir = os.path.join(current_dir, "output")
 os.makedirs(output_dir, exist_ok=True)
+_transcript_cache = diskcache.Cache(os.path.join(current_dir, ".transcript_cache"))
+TRANSCRIPT_CACHE_TTL = 86400  # seconds
+TRANSCRIPT_FETCH_RETRIES = 3
+TRANSCRIPT_RETRY_BACKOFF = 0.3  # seconds, doubled after each failed attempt
 
 with open(mapping_path, "r") as f:
     gloss_map = json.load(f)
@@ -23,11 +28,12 @@ word_to_pkl = {v.lower(): k for k, v in gloss_map.items()}
 dataset_words = set(word_to_pkl.keys())
 
 animator = WordToSMPLX(model_path=os.path.join(current_dir, "models"))
+_WORD_RE = re.compile(r"[a-z]+(?:'[a-z]+)*")
+_VIDEO_ID_RE = re.compile(r"(?:v=|/)([0-9A-Za-z_-]{11})")
 
 # --- Helper: Extract YouTube video ID ---
 def extract_video_id(url):
-    regex = r"(?:v=|\/)([0-9A-Za-z_-]{11}).*"
-    match = re.search(regex, url)
+    match = _VIDEO_ID_RE.search(url)
     if match:
         return match.group(1)
     elif len(url) == 11:
@@ -35,16 +41,49 @@ def extract_video_id(url):
     else:
         raise ValueError("Invalid YouTube URL or video ID.")
 
+# --- Helper: Fetch transcript with disk cache and retry ---
+def fetch_transcript(video_id):
+    transcript = _transcript_cache.get(video_id)
+    if transcript is not None:
+        return transcript
+    delay = TRANSCRIPT_RETRY_BACKOFF
+    for attempt in range(TRANSCRIPT_FETCH_RETRIES):
+        try:
+            transcript = YouTubeTranscriptApi.get_transcript(video_id)
+            break
+        except (TranscriptsDisabled, NoTranscriptFound, VideoUnavailable):
+            raise  # Permanent for this video, retrying won't help
+        except Exception:
+            if attempt == TRANSCRIPT_FETCH_RETRIES - 1:
+                raise
+            time.sleep(delay)
+            delay *= 2
+    _transcript_cache.set(video_id, transcript, expire=TRANSCRIPT_CACHE_TTL)
+    return transcript
+
 def transcript_to_words(transcript):
     # transcript: list of dicts with 'text'
     words = []
+    seen = set()
     for entry in transcript:
-        for w in entry['text'].lower().split():
-            w_clean = w.strip(string.punctuation)
-            if w_clean in dataset_words and w_clean not in words:
-                words.append(w_clean)
+        for w in _WORD_RE.findall(entry['text'].lower()):
+            if w in dataset_words and w not in seen:
+                seen.add(w)
+                words.append(w)
     return words
 
+# --- Helper: Per-word animation cache ---
+def render_word_cached(word):
+    # Reuse output/{word}_animation.mp4 if it exists, otherwise render it once and persist it
+    word_video_path = os.path.join(output_dir, f"{word}_animation.mp4")
+    if os.path.exists(word_video_path):
+        reader = imageio.get_reader(word_video_path)
+        frames = [frame for frame in reader]
+        reader.close()
+        return frames
+    pose_data = animator.load_pose_sequence(os.path.join(dataset_dir, word_to_pkl[word]))
+    return list(animator.render_animation(pose_data, save_path=word_video_path, fps=15))
+
 # --- Endpoint: Get transcript from YouTube ---
 @app.route('/asl_from_youtube', methods=['POST'])
 def asl_from_youtube():
@@ -54,7 +93,7 @@ def asl_from_youtube():
         return jsonify({'error': 'Missing YouTube URL'}), 400
     try:
         video_id = extract_video_id(url)
-        transcript = YouTubeTranscriptApi.get_transcript(video_id)
+        transcript = fetch_transcript(video_id)
     except (TranscriptsDisabled, NoTranscriptFound, VideoUnavailable):
         return jsonify({'error': 'No transcript available for this video.'}), 404
     except Exception as e:
@@ -69,17 +108,11 @@ def asl_from_youtube():
     if os.path.exists(video_path):
         return jsonify({'url': f"/output/{video_filename}"})
 
-    # Load and concatenate pose data
-    pose_data_sequences = []
+    # Assemble the clip from cached per-word animations
+    all_frames = []
     for word in words:
-        pkl_file = os.path.join(dataset_dir, word_to_pkl[word])
-        pose_data_dict = animator.load_pose_sequence(pkl_file)
-        smplx_params_np = np.stack(pose_data_dict['smplx'])
-        pose_data_sequences.append(smplx_params_np)
-    all_params = np.vstack(pose_data_sequences)
-    pose_data = animator.load_pose_sequence(os.path.join(dataset_dir, word_to_pkl[words[0]]))
-    pose_data['smplx'] = [frame for frame in all_params]
-    animator.render_animation(pose_data, save_path=video_path, fps=15)
+        all_frames.extend(render_word_cached(word))
+    imageio.mimsave(video_path, all_frames, fps=15)
     return jsonify({'url': f"/output/{video_filename}"})
 
 # --- Serve generated videos ---
@@ -92,4 +125,5 @@ def home():
     return "SMPLX ASL Backend is running. Use the /asl_from_youtube endpoint."
 
 if __name__ == '__main__':
+    # Development server only; for concurrent clients run under gunicorn, e.g. `gunicorn -w 4 app:app`
     app.run(port=5000, debug=True)
\ No newline at end of file
@@ -2,15 +2,14 @@ from youtube_transcript_api import YouTubeTranscriptApi
 import sys
 import re
 
+# Handles various YouTube URL formats
+_VIDEO_ID_RE = re.compile(r"(?:v=|/)([0-9A-Za-z_-]{11})")
+
 def extract_video_id(url):
     """
     Extracts the video ID from a YouTube URL.
     """
-    # Handles various YouTube URL formats
-    regex = (
-        r"(?:v=|\/)([0-9A-Za-z_-]{11}).*"
-    )
-    match = re.search(regex, url)
+    match = _VIDEO_ID_RE.search(url)
     if match:
         return match.group(1)
     elif len(url) == 11:
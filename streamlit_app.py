@@ -28,6 +28,33 @@ def blend_pose_sequences(seq_a, seq_b, n_blend=5):
     # Concatenate: part of A, blended part, part of B
     return np.vstack([seq_a[:-n_blend, :], blended_part_np, seq_b[n_blend:, :]])
 
+# --- Video Concatenation ---
+def concat_videos_ffmpeg(video_paths, out_path):
+    # Lossless container-level concat via ffmpeg's concat demuxer; returns False on failure
+    with tempfile.NamedTemporaryFile('w', delete=False, suffix='.txt') as list_file:
+        for path in video_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped}'\n")
+    try:
+        subprocess.run(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file.name, '-c', 'copy', out_path],
+            check=True, capture_output=True
+        )
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    finally:
+        os.remove(list_file.name)
+
+def concat_videos_decode(video_paths, out_path):
+    # Fallback: decode every clip and re-encode the frames
+    all_frames = []
+    for path in video_paths:
+        reader = imageio.get_reader(path)
+        all_frames.extend([frame for frame in reader])
+        reader.close()
+    imageio.mimsave(out_path, all_frames, fps=15)
+
 st.set_page_config(page_title="SMPL-X Animation Demo", layout="centered")
 st.title("SMPL-X Word Animation")
 
@@ -86,30 +113,28 @@ if st.button("✨ Generate Animation", type="primary"):
                     video_filename = f"{selected_words[0]}_animation.mp4"
                     video_path = os.path.join(output_dir, video_filename)
                     if not os.path.exists(video_path):
-                        pose_data = animator.load_pose_sequence(os.path.join(dataset_dir, word_to_pkl[selected_words[0]]))
-                        animator.render_animation(pose_data, save_path=video_path, fps=15)
+                        animator.render_animation({'smplx': pose_data_sequences[0]}, save_path=video_path, fps=15)
                     st.session_state.video_path_to_display = video_path
                     st.session_state.video_header = f"Animation for: {selected_words[0]}"
                 else:
-                    # Concatenate videos in memory using imageio and tempfile
-                    all_frames = []
-                    for word in selected_words:
+                    word_video_paths = []
+                    for word, smplx_params_np in zip(selected_words, pose_data_sequences):
                         video_filename = f"{word}_animation.mp4"
                         video_path = os.path.join(output_dir, video_filename)
                         if not os.path.exists(video_path):
-                            pose_data = animator.load_pose_sequence(os.path.join(dataset_dir, word_to_pkl[word]))
-                            animator.render_animation(pose_data, save_path=video_path, fps=15)
+                            animator.render_animation({'smplx': smplx_params_np}, save_path=video_path, fps=15)
                         if os.path.exists(video_path):
-                            reader = imageio.get_reader(video_path)
-                            all_frames.extend([frame for frame in reader])
-                            reader.close()
+                            word_video_paths.append(video_path)
                         else:
                             st.error(f"Video for '{word}' could not be found or rendered.")
-                    if all_frames:
+                    if word_video_paths:
                         with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as tmpfile:
-                            imageio.mimsave(tmpfile.name, all_frames, fps=15)
-                            st.session_state.video_path_to_display = tmpfile.name
-                            st.session_state.video_header = f"Combined Animation: {', '.join(selected_words)}"
+                            combined_path = tmpfile.name
+                        # Stream-copy with ffmpeg; re-encode from decoded frames only if that fails
+                        if not concat_videos_ffmpeg(word_video_paths, combined_path):
+                            concat_videos_decode(word_video_paths, combined_path)
+                        st.session_state.video_path_to_display = combined_path
+                        st.session_state.video_header = f"Combined Animation: {', '.join(selected_words)}"
                     else:
                         st.session_state.video_path_to_display = None
                         st.session_state.video_header = ""
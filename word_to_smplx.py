@@ -3,11 +3,14 @@ os.environ['PYOPENGL_PLATFORM'] = 'egl' # Attempt to use EGL for headless render
 
 import sys
 import torch
+import torch.nn.functional as F
 import smplx
 import numpy as np
 import imageio
 import json
-from scipy.ndimage import gaussian_filter1d
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Import rendering dependencies
 try:
@@ -41,8 +44,16 @@ except ImportError:
 # 20: Right wrist
 # (Hand joints start at 40 in trial.py)
 
+HAND_SMOOTHING_SIGMA = 0.3  # Temporal Gaussian sigma (frames) for hand pose smoothing
+
+@functools.lru_cache(maxsize=256)
+def _load_pkl(pkl_path):
+    # Always load to CPU, allow for CUDA-originated files
+    with open(pkl_path, "rb") as f:
+        return torch.load(f, map_location='cpu', weights_only=False)
+
 class WordToSMPLX:
-    def __init__(self, model_path="models", gender='neutral', viewport_width=640, viewport_height=480):
+    def __init__(self, model_path="models", gender='neutral', viewport_width=640, viewport_height=480, prefetch_queue_depth=2, device=None):
         # model_path is "models"
         # The smplx library (when model_type='smplx') expects model_path to be the directory *containing* the 'smplx' subfolder.
         # The actual model files are expected to be in model_path/smplx/
@@ -52,6 +63,8 @@ class WordToSMPLX:
         if not os.path.exists(actual_model_file_location):
             raise ValueError(f"Model file not found at: {actual_model_file_location}. Please ensure models are in 'models/smplx/'")
 
+        # SMPL-X and hand pose preprocessing share one device
+        self.device = torch.device(device) if device is not None else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.smplx_model = smplx.create(
             model_path=model_path,  # This should be the parent directory, e.g., "models"
             model_type='smplx',     # This tells the library to look inside model_path + '/smplx'
@@ -72,10 +85,26 @@ class WordToSMPLX:
             num_expression_coeffs=10,
             flat_hand_mean=False,  # Allow curved hand poses for better clenching
             batch_size=1
-        )
+        ).to(self.device)
 
         self.finger_joint_mapping = self._get_finger_joint_mapping()
         self.hand_joint_limits = self._get_hand_joint_limits()
+        self._hand_lo, self._hand_hi = self._get_hand_joint_bounds()
+        self._hand_lo_t = torch.from_numpy(self._hand_lo).to(self.device)
+        self._hand_hi_t = torch.from_numpy(self._hand_hi).to(self.device)
+        self._smoothing_kernels = {}  # sigma -> Gaussian kernel on self.device
+        # Neutral batch-1 inputs, expanded to N frames per call so the batch-1 model can run any batch size
+        self._neutral_inputs = {
+            'betas': torch.zeros((1, 10), device=self.device),
+            'expression': torch.zeros((1, 10), device=self.device),
+            'jaw_pose': torch.zeros((1, 3), device=self.device),
+            'leye_pose': torch.zeros((1, 3), device=self.device),
+            'reye_pose': torch.zeros((1, 3), device=self.device),
+            'transl': torch.zeros((1, 3), device=self.device),
+        }
+        self._flip_x = torch.tensor([np.pi, 0.0, 0.0], device=self.device)
+        self._get_smoothing_kernel(HAND_SMOOTHING_SIGMA)  # Build the default kernel up front
+        self.prefetch_queue_depth = prefetch_queue_depth  # Meshes built ahead of the renderer
         
         if pyrender and trimesh:
             self.camera = pyrender.PerspectiveCamera(yfov=np.pi / 5.0)
@@ -83,6 +112,10 @@ class WordToSMPLX:
             self.cam_pose = np.eye(4)
             self.cam_pose[2, 3] = 2.0
             self.cam_pose[1, 3] = -0.2
+            # Persistent scene; only the body mesh node is swapped per frame
+            self._scene = pyrender.Scene()
+            self._scene.add(self.camera, pose=self.cam_pose)
+            self._scene.add(self.light, pose=self.cam_pose)
             self.renderer = pyrender.OffscreenRenderer(
                 viewport_width=viewport_width,
                 viewport_height=viewport_height
@@ -131,132 +164,150 @@ class WordToSMPLX:
         }
         return limits
 
-    def _apply_anatomical_constraints_to_frame(self, hand_pose_frame_np):
-        """Applies joint limits to a single frame of hand pose (45 params)."""
-        constrained_pose = np.copy(hand_pose_frame_np)
-        
+    def _get_hand_joint_bounds(self):
+        """Flatten the joint limits into (45,) lo/hi arrays laid out like finger_joint_mapping."""
+        lo = np.empty(45, dtype=np.float32)
+        hi = np.empty(45, dtype=np.float32)
         for finger_name, joints in self.finger_joint_mapping.items():
             for joint_type, (start_idx, end_idx) in joints.items():
-                joint_params = constrained_pose[start_idx:end_idx] # Should be 3 params
-
                 if finger_name == 'thumb':
-                    if joint_type == 'cmc':
-                        joint_params[0] = np.clip(joint_params[0], *self.hand_joint_limits['thumb_cmc_flexion'])
-                        joint_params[1] = np.clip(joint_params[1], *self.hand_joint_limits['thumb_cmc_abduction'])
-                        joint_params[2] = np.clip(joint_params[2], *self.hand_joint_limits['thumb_cmc_twist'])
-                    elif joint_type == 'mcp':
-                        joint_params[0] = np.clip(joint_params[0], *self.hand_joint_limits['thumb_mcp_flexion'])
-                        joint_params[1] = np.clip(joint_params[1], *self.hand_joint_limits['thumb_mcp_abduction'])
-                        joint_params[2] = np.clip(joint_params[2], *self.hand_joint_limits['thumb_mcp_twist'])
-                    elif joint_type == 'ip':
-                        joint_params[0] = np.clip(joint_params[0], *self.hand_joint_limits['thumb_ip_flexion'])
-                        joint_params[1] = np.clip(joint_params[1], *self.hand_joint_limits['thumb_ip_side_flex'])
-                        joint_params[2] = np.clip(joint_params[2], *self.hand_joint_limits['thumb_ip_twist'])
+                    second = 'side_flex' if joint_type == 'ip' else 'abduction'
+                    keys = [f'thumb_{joint_type}_flexion', f'thumb_{joint_type}_{second}', f'thumb_{joint_type}_twist']
                 else: # Index, Middle, Ring, Pinky
-                    if joint_type == 'mcp':
-                        joint_params[0] = np.clip(joint_params[0], *self.hand_joint_limits['mcp_flexion'])
-                        joint_params[1] = np.clip(joint_params[1], *self.hand_joint_limits['mcp_abduction'])
-                        joint_params[2] = np.clip(joint_params[2], *self.hand_joint_limits['mcp_twist'])
-                    elif joint_type == 'pip':
-                        joint_params[0] = np.clip(joint_params[0], *self.hand_joint_limits['pip_flexion'])
-                        joint_params[1] = np.clip(joint_params[1], *self.hand_joint_limits['pip_side_flex'])
-                        joint_params[2] = np.clip(joint_params[2], *self.hand_joint_limits['pip_twist'])
-                    elif joint_type == 'dip':
-                        joint_params[0] = np.clip(joint_params[0], *self.hand_joint_limits['dip_flexion'])
-                        joint_params[1] = np.clip(joint_params[1], *self.hand_joint_limits['dip_side_flex'])
-                        joint_params[2] = np.clip(joint_params[2], *self.hand_joint_limits['dip_twist'])
-                
-                constrained_pose[start_idx:end_idx] = joint_params
-        return constrained_pose
+                    second = 'abduction' if joint_type == 'mcp' else 'side_flex'
+                    keys = [f'{joint_type}_flexion', f'{joint_type}_{second}', f'{joint_type}_twist']
+                for offset, key in enumerate(keys):
+                    lo[start_idx + offset], hi[start_idx + offset] = self.hand_joint_limits[key]
+        return lo, hi
+
+    def _apply_anatomical_constraints_to_frame(self, hand_pose_frame_np):
+        """Applies joint limits to a single frame of hand pose (45 params)."""
+        return np.clip(hand_pose_frame_np, self._hand_lo, self._hand_hi)
 
-    def _process_hand_pose_data(self, hand_pose_np, sigma=0.3):
-        """Smoothes and applies anatomical constraints to hand pose data."""
+    def _get_smoothing_kernel(self, sigma, truncate=4.0):
+        """Returns a normalized 1-D Gaussian kernel matching gaussian_filter1d's taps, cached by sigma."""
+        kernel = self._smoothing_kernels.get(sigma)
+        if kernel is None:
+            radius = int(truncate * sigma + 0.5)
+            x = torch.arange(-radius, radius + 1, dtype=torch.float32, device=self.device)
+            kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+            kernel = (kernel / kernel.sum()).view(1, 1, -1)
+            self._smoothing_kernels[sigma] = kernel
+        return kernel
+
+    def _process_hand_pose_data(self, hand_pose, sigma=HAND_SMOOTHING_SIGMA):
+        """Smoothes and applies anatomical constraints to an [N, 45] hand pose tensor."""
         # 1. Smoothing
-        smoothed_hand_pose = np.copy(hand_pose_np)
-        if smoothed_hand_pose.shape[0] > 1: # Need at least 2 frames to smooth
-            for i in range(smoothed_hand_pose.shape[1]): # Iterate over 45 parameters
-                smoothed_hand_pose[:, i] = gaussian_filter1d(smoothed_hand_pose[:, i], sigma=sigma, mode='nearest')
+        if hand_pose.shape[0] > 1: # Need at least 2 frames to smooth
+            # Depthwise conv over time for all 45 parameters; replicate padding matches mode='nearest'
+            kernel = self._get_smoothing_kernel(sigma)
+            radius = kernel.shape[-1] // 2
+            channels = hand_pose.shape[1]
+            padded = F.pad(hand_pose.t().unsqueeze(0), (radius, radius), mode='replicate')
+            smoothed_hand_pose = F.conv1d(padded, kernel.expand(channels, 1, -1), groups=channels).squeeze(0).t()
+        else:
+            smoothed_hand_pose = hand_pose
         
-        # 2. Apply anatomical constraints per frame
-        constrained_hand_pose = np.zeros_like(smoothed_hand_pose)
-        for i in range(smoothed_hand_pose.shape[0]): # Iterate over frames
-            constrained_hand_pose[i, :] = self._apply_anatomical_constraints_to_frame(smoothed_hand_pose[i, :])
+        # 2. Apply anatomical constraints to all frames at once
+        constrained_hand_pose = torch.clamp(smoothed_hand_pose, self._hand_lo_t, self._hand_hi_t)
             
         # 3. Final global clamp as a safeguard (optional, could be part of _apply_anatomical_constraints_to_frame)
-        # constrained_hand_pose = np.clip(constrained_hand_pose, *self.hand_joint_limits['general_clamp'])
+        # constrained_hand_pose = torch.clamp(constrained_hand_pose, *self.hand_joint_limits['general_clamp'])
         return constrained_hand_pose
 
+    def _build_mesh(self, vertices, faces):
+        """Builds the pyrender mesh for one frame of SMPL-X vertices."""
+        # process=False skips trimesh's vertex merging/validation; SMPL-X topology is already clean
+        mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+        return pyrender.Mesh.from_trimesh(mesh)
+
     def load_pose_sequence(self, pkl_path):
-        # Always load to CPU, allow for CUDA-originated files
-        with open(pkl_path, "rb") as f:
-            data = torch.load(f, map_location='cpu', weights_only=False)
-        return data
+        # Shallow copy so callers replacing keys don't pollute the cache
+        return dict(_load_pkl(os.path.abspath(pkl_path)))
 
     def render_animation(self, pose_data, save_path=None, fps=15):
         smplx_data = pose_data.get('smplx', None)
         if smplx_data is None or not (isinstance(smplx_data, np.ndarray) and isinstance(smplx_data[0], np.ndarray)):
             raise ValueError("'smplx' key missing or has unexpected structure in pose_data.")
-        smplx_params = np.stack(smplx_data)  # shape: [N, D]
+        # Accept either a 2-D [N, D] array or an array of per-frame vectors
+        smplx_params = smplx_data if smplx_data.ndim == 2 else np.stack(smplx_data)  # shape: [N, D]
         N = smplx_params.shape[0]
-        global_orient = torch.tensor(smplx_params[:, 0:3], dtype=torch.float32)
-        body_pose = torch.tensor(smplx_params[:, 3:66], dtype=torch.float32)
+        # Zero-copy views on CPU; nothing below may modify them in place since they can alias the caller's data
+        smplx_params = smplx_params.astype(np.float32, copy=False)
+        global_orient = torch.from_numpy(smplx_params[:, 0:3]).to(self.device)
+        body_pose = torch.from_numpy(smplx_params[:, 3:66]).to(self.device)
         
-        # Process hand poses
-        left_hand_raw_np = smplx_params[:, 66:111]
-        right_hand_raw_np = smplx_params[:, 111:156]
+        # Process hand poses on the SMPL-X device
+        left_hand_raw = torch.from_numpy(smplx_params[:, 66:111]).to(self.device)
+        right_hand_raw = torch.from_numpy(smplx_params[:, 111:156]).to(self.device)
         
-        left_hand_processed_np = self._process_hand_pose_data(left_hand_raw_np)
-        right_hand_processed_np = self._process_hand_pose_data(right_hand_raw_np)
-        
-        left_hand_pose = torch.tensor(left_hand_processed_np, dtype=torch.float32)
-        right_hand_pose = torch.tensor(right_hand_processed_np, dtype=torch.float32)
+        left_hand_pose = self._process_hand_pose_data(left_hand_raw)
+        right_hand_pose = self._process_hand_pose_data(right_hand_raw)
+
+        global_orient = global_orient + self._flip_x  # Rotate 180° around X axis
+        # Check for NaNs in hand poses and replace with zeros if found
+        nan_frames = torch.isnan(left_hand_pose).any(dim=1) | torch.isnan(right_hand_pose).any(dim=1)
+        if nan_frames.any():
+            print(f"Warning: NaN detected in hand poses at frames {nan_frames.nonzero().flatten().tolist()}, using neutral pose")
+            # In place: both tensors are fresh outputs of _process_hand_pose_data
+            left_hand_pose.nan_to_num_()
+            right_hand_pose.nan_to_num_()
 
-        frames = []
-        for i in range(N):
-            go = global_orient[i].unsqueeze(0).clone()
-            go[0, 0] += np.pi  # Rotate 180° around X axis
-            bp = body_pose[i].unsqueeze(0)
-            lhp = left_hand_pose[i].unsqueeze(0)
-            rhp = right_hand_pose[i].unsqueeze(0)
-            # Check for NaNs in hand poses and replace with zeros if found
-            if torch.isnan(lhp).any() or torch.isnan(rhp).any():
-                print(f"Warning: NaN detected in hand poses at frame {i}, using neutral pose")
-                lhp = torch.nan_to_num(lhp)
-                rhp = torch.nan_to_num(rhp)
+        # Run SMPL-X once over all N frames; the graph is never backpropagated
+        neutral_inputs = {k: v.expand(N, -1) for k, v in self._neutral_inputs.items()}  # Views, no allocation
+        with torch.no_grad():
             try:
                 output = self.smplx_model(
-                    body_pose=bp,
-                    right_hand_pose=rhp,
-                    left_hand_pose=lhp,
-                    global_orient=go,
-                    betas=torch.zeros((1, 10)),
-                    return_verts=True
+                    body_pose=body_pose,
+                    right_hand_pose=right_hand_pose,
+                    left_hand_pose=left_hand_pose,
+                    global_orient=global_orient,
+                    return_verts=True,
+                    **neutral_inputs
                 )
             except Exception as e:
-                print(f"Error in SMPL-X model at frame {i}: {e}")
+                print(f"Error in SMPL-X model: {e}")
                 output = self.smplx_model(
-                    body_pose=bp,
-                    right_hand_pose=torch.zeros_like(rhp),
-                    left_hand_pose=torch.zeros_like(lhp),
-                    global_orient=go,
-                    betas=torch.zeros((1, 10)),
-                    return_verts=True
+                    body_pose=body_pose,
+                    right_hand_pose=torch.zeros_like(right_hand_pose),
+                    left_hand_pose=torch.zeros_like(left_hand_pose),
+                    global_orient=global_orient,
+                    return_verts=True,
+                    **neutral_inputs
                 )
-            if self.renderer and pyrender and trimesh:
-                vertices = output.vertices.detach().cpu().numpy().squeeze()
-                mesh = trimesh.Trimesh(vertices=vertices, faces=self.smplx_model.faces)
-                scene = pyrender.Scene()
-                mesh_pyrender = pyrender.Mesh.from_trimesh(mesh)
-                scene.add(mesh_pyrender)
-                scene.add(self.camera, pose=self.cam_pose)
-                scene.add(self.light, pose=self.cam_pose)
-                color, _ = self.renderer.render(scene)
-                frames.append(color)
-            else:
-                print("Rendering not available. Returning pose parameters only.")
-                return output
+        if not (self.renderer and pyrender and trimesh):
+            print("Rendering not available. Returning pose parameters only.")
+            return output
+
+        all_vertices = output.vertices.detach().cpu().numpy()
+        frames = np.empty((N, self.renderer.viewport_height, self.renderer.viewport_width, 3), dtype=np.uint8)
+        # Build the mesh for the next frame on a worker thread while the current one renders.
+        # Rendering itself stays on this thread since the pyrender/EGL context is not thread-safe.
+        mesh_node = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque(
+                executor.submit(self._build_mesh, all_vertices[i], self.smplx_model.faces)
+                for i in range(min(self.prefetch_queue_depth, N))
+            )
+            try:
+                for i in range(N):
+                    mesh = pending.popleft().result()
+                    next_i = i + self.prefetch_queue_depth
+                    if next_i < N:
+                        pending.append(executor.submit(self._build_mesh, all_vertices[next_i], self.smplx_model.faces))
+                    if mesh_node is not None:
+                        self._scene.remove_node(mesh_node)
+                    mesh_node = self._scene.add(mesh)
+                    color, _ = self.renderer.render(self._scene)
+                    np.copyto(frames[i], color)
+            finally:
+                if mesh_node is not None:
+                    self._scene.remove_node(mesh_node)
         if save_path:
-            imageio.mimsave(save_path, frames, fps=fps)
+            # Stream frames straight into the encoder from the preallocated buffer
+            with imageio.get_writer(save_path, fps=fps) as writer:
+                for i in range(N):
+                    writer.append_data(frames[i])
         return frames
 
 def convert_to_cpu(input_path, output_path):
@@ -267,11 +318,16 @@ def convert_to_cpu(input_path, output_path):
             data[k] = data[k].cpu()
     torch.save(data, output_path)
 
+@functools.lru_cache(maxsize=None)
+def _mirror_mask(dim):
+    mask = torch.ones(dim)
+    mask[1::3] = -1  # Flip Y
+    mask[2::3] = -1  # Flip Z
+    return mask
+
 def mirror_pose(pose):
-    mirrored = pose.clone()
-    mirrored[..., 1::3] *= -1  # Flip Y
-    mirrored[..., 2::3] *= -1  # Flip Z
-    return mirrored
+    # One contiguous multiply by a cached +/-1 mask instead of two strided writes
+    return pose * _mirror_mask(pose.shape[-1]).to(pose.device, pose.dtype)
 
 if __name__ == "__main__":
     print("Word to SMPL-X Animation Generator (Cleaned)")